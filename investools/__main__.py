@@ -1,14 +1,10 @@
 import sys
+import typing as t
 
 import click
 import tabulate
 
-try:
-    from devtools import debug
-except ImportError:
-    debug = print
-
-from investools import model, rebalancing, returns, sheets
+from investools import model, rebalancing
 
 
 @click.group(
@@ -25,6 +21,10 @@ from investools import model, rebalancing, returns, sheets
     show_default=True,
 )
 def main(ctx: click.Context, google_sheet_id: str) -> None:
+    # Imported here because gspread is the slowest import by far, and isn't needed for
+    # --help or shell completion
+    from investools import sheets
+
     sheet_client = sheets.get_client()
     sheet = sheet_client.open_by_key(google_sheet_id)
     ctx.obj = sheets.build_portfolio(sheet)
@@ -33,7 +33,7 @@ def main(ctx: click.Context, google_sheet_id: str) -> None:
 @main.command()
 @click.pass_obj
 def print_portfolio(portfolio: model.Portfolio) -> None:
-    debug(portfolio)
+    click.echo(portfolio.json(indent=2))
 
 
 @main.command()
@@ -52,7 +52,7 @@ def summary(portfolio: model.Portfolio) -> None:
     print("=========")
     print()
     print(
-        tabulate.tabulate(
+        _tabulate(
             [
                 (
                     position.account.name,
@@ -72,45 +72,28 @@ def summary(portfolio: model.Portfolio) -> None:
                 "Current Investment",
                 "Current Account %",
             ],
+            text_columns=[0, 1],
             floatfmt=".2f",
         ),
         end="\n\n",
     )
 
-    allocation_results = []
-    for allocation in portfolio.allocations:
-        matching_asset_tickers = {
-            asset.ticker for asset in portfolio.assets if allocation.matches(asset)
-        }
-
-        matching_asset_investments = [
-            position.get_current_investment()
-            for position in positions
-            if position.asset.ticker in matching_asset_tickers
-        ]
-        matching_assets_total_investment = sum(matching_asset_investments)
-        matching_assets_proportion = (
-            matching_assets_total_investment / total_portfolio_value
-        )
-        matching_assets_drift = allocation.proportion - matching_assets_proportion
-
-        allocation_results.append(
-            [
-                allocation.name,
-                allocation.proportion * 100,
-                matching_assets_proportion * 100,
-                matching_assets_drift * 100,
-            ]
-        )
+    allocation_results = _get_allocation_results(
+        portfolio,
+        positions,
+        rebalancing.Position.get_current_investment,
+        total_portfolio_value,
+    )
 
     print("===========")
     print("ALLOCATIONS")
     print("===========")
     print()
     print(
-        tabulate.tabulate(
+        _tabulate(
             allocation_results,
             headers=["Allocation", "Target %", "Actual %", "Drift %"],
+            text_columns=[0],
             floatfmt=".2f",
         )
     )
@@ -127,6 +110,8 @@ def summary(portfolio: model.Portfolio) -> None:
     show_default=True,
 )
 def project_returns(portfolio: model.Portfolio, years: int) -> None:
+    from investools import returns
+
     tax_exempt_return_rates_by_asset = returns.project_tax_exempt_rates(
         portfolio.assets
     )
@@ -152,8 +137,10 @@ def project_returns(portfolio: model.Portfolio, years: int) -> None:
         )
 
     print(
-        tabulate.tabulate(
-            return_rates, headers=["Asset", "Tax-exempt", "Tax-deferred", "Taxable"]
+        _tabulate(
+            return_rates,
+            headers=["Asset", "Tax-exempt", "Tax-deferred", "Taxable"],
+            text_columns=[0],
         )
     )
 
@@ -177,36 +164,69 @@ def project_returns(portfolio: model.Portfolio, years: int) -> None:
     help="Max number of seconds to wait for optimal solution",
     show_default=True,
 )
+@click.option(
+    "--fast/--exact",
+    default=False,
+    help=(
+        "Solve for fractional shares and round down to whole shares, falling back to "
+        "an exact solve if the rounded result breaks any constraint"
+    ),
+    show_default=True,
+)
+@click.option(
+    "--solver",
+    "solver_str",
+    type=click.Choice([e.value for e in rebalancing.Solver]),
+    default=rebalancing.Solver.AUTO.value,
+    help="Which solver to use, where auto prefers HiGHS and falls back to CBC",
+    show_default=True,
+)
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    help="Show the solver's output",
+)
 def rebalance(
     portfolio: model.Portfolio,
     allowed_sales_str: str,
     max_time: int,
+    fast: bool,
+    solver_str: str,
+    verbose: bool,
 ) -> None:
     allowed_sales = rebalancing.AllowedSales(allowed_sales_str)
+    solver = rebalancing.Solver(solver_str)
 
     try:
-        positions = rebalancing.rebalance(portfolio, allowed_sales, max_time)
-    except rebalancing.CannotRebalance as err:
+        positions = rebalancing.rebalance(
+            portfolio, allowed_sales, max_time, fast, solver, verbose
+        )
+    except (rebalancing.CannotRebalance, rebalancing.SolverNotAvailable) as err:
         sys.exit(str(err))
 
+    # The solution is fixed from here on, so compute each position's delta once for
+    # all of the tables below
+    deltas = [position.get_delta() for position in positions]
+
     print("=========")
     print("REBALANCE")
     print("=========")
     print()
     print(
-        tabulate.tabulate(
+        _tabulate(
             [
                 (
                     position.account.name,
                     position.asset.ticker,
                     position.get_current_shares(),
                     position.get_target_shares(),
-                    position.get_delta(),
+                    delta,
                     position.asset.share_price,
-                    (position.get_delta() * position.asset.share_price),
+                    (delta * position.asset.share_price),
                     100 * position.get_target_account_proportion(portfolio.assets),
                 )
-                for position in positions
+                for position, delta in zip(positions, deltas)
             ],
             headers=[
                 "Account",
@@ -218,6 +238,7 @@ def rebalance(
                 "Estimated Trade Amount",
                 "Target Account %",
             ],
+            text_columns=[0, 1],
             floatfmt=".2f",
         ),
         end="\n\n",
@@ -228,31 +249,36 @@ def rebalance(
     sale_rows = []
     for position in positions:
         for sale in position.generate_sales(allowed_sales):
+            lot = sale.asset_lot
+            # Capital gains are derived from the cost basis and proceeds on every access
+            capital_gains = sale.capital_gains
+            # The hold term is worked out from the current date on every access too
+            hold_term = lot.hold_term
             sale_rows.append(
                 (
                     position.account.name,
                     position.asset.ticker,
-                    sale.asset_lot.purchase_date,
-                    sale.asset_lot.shares,
+                    lot.purchase_date,
+                    lot.shares,
                     sale.share_count,
                     sale.cost_basis,
                     sale.proceeds,
-                    sale.capital_gains,
-                    sale.asset_lot.hold_term.name if sale.asset_lot.hold_term else None,
+                    capital_gains,
+                    hold_term.name if hold_term else None,
                 )
             )
-            if sale.capital_gains:
-                if sale.asset_lot.hold_term is model.HoldTerm.LONG:
-                    net_ltcg += sale.capital_gains
+            if capital_gains:
+                if hold_term is model.HoldTerm.LONG:
+                    net_ltcg += capital_gains
                 else:
-                    net_stcg += sale.capital_gains
+                    net_stcg += capital_gains
 
     print("=====")
     print("SALES")
     print("=====")
     print()
     print(
-        tabulate.tabulate(
+        _tabulate(
             sale_rows,
             headers=[
                 "Account",
@@ -265,6 +291,7 @@ def rebalance(
                 "Capital Gain/Loss",
                 "Hold Term",
             ],
+            text_columns=[0, 1],
         ),
         end="\n\n",
     )
@@ -276,16 +303,16 @@ def rebalance(
     print("=========")
     print()
     print(
-        tabulate.tabulate(
+        _tabulate(
             [
                 (
                     position.account.name,
                     position.asset.ticker,
-                    position.get_delta(),
-                    (position.get_delta() * position.asset.share_price),
+                    delta,
+                    (delta * position.asset.share_price),
                 )
-                for position in positions
-                if position.get_delta() > 0
+                for position, delta in zip(positions, deltas)
+                if delta > 0
             ],
             headers=[
                 "Account",
@@ -293,23 +320,52 @@ def rebalance(
                 "Shares to Purchase",
                 "Cost",
             ],
+            text_columns=[0, 1],
         ),
         end="\n\n",
     )
 
     total_portfolio_value = portfolio.get_total_value()
+    allocation_results = _get_allocation_results(
+        portfolio,
+        positions,
+        rebalancing.Position.get_target_investment,
+        total_portfolio_value,
+    )
+
+    print("=====================")
+    print("RESULTING ALLOCATIONS")
+    print("=====================")
+    print()
+    print(
+        _tabulate(
+            allocation_results,
+            headers=["Allocation", "Target %", "Actual %", "Drift %"],
+            text_columns=[0],
+            floatfmt=".2f",
+        )
+    )
+
+
+def _get_allocation_results(
+    portfolio: model.Portfolio,
+    positions: t.Sequence[rebalancing.Position],
+    get_investment: t.Callable[[rebalancing.Position], float],
+    total_portfolio_value: float,
+) -> t.List[t.List[t.Any]]:
+    # Total the investments per allocation in a single pass over the positions, rather
+    # than rescanning every position for each allocation
+    total_investment_by_allocation = {
+        allocation.id: 0.0 for allocation in portfolio.allocations
+    }
+    for position in positions:
+        investment = get_investment(position)
+        for allocation in portfolio.get_matching_allocations(position.asset):
+            total_investment_by_allocation[allocation.id] += investment
+
     allocation_results = []
     for allocation in portfolio.allocations:
-        matching_asset_tickers = {
-            asset.ticker for asset in portfolio.assets if allocation.matches(asset)
-        }
-
-        matching_asset_investments = [
-            position.get_target_investment()
-            for position in positions
-            if position.asset.ticker in matching_asset_tickers
-        ]
-        matching_assets_total_investment = sum(matching_asset_investments)
+        matching_assets_total_investment = total_investment_by_allocation[allocation.id]
         matching_assets_proportion = (
             matching_assets_total_investment / total_portfolio_value
         )
@@ -324,17 +380,26 @@ def rebalance(
             ]
         )
 
-    print("=====================")
-    print("RESULTING ALLOCATIONS")
-    print("=====================")
-    print()
-    print(
-        tabulate.tabulate(
-            allocation_results,
-            headers=["Allocation", "Target %", "Actual %", "Drift %"],
-            floatfmt=".2f",
-        )
-    )
+    return allocation_results
+
+
+def _tabulate(
+    rows: t.Iterable[t.Sequence[t.Any]],
+    *,
+    headers: t.Sequence[str],
+    text_columns: t.List[int],
+    **kwargs: t.Any,
+) -> str:
+    """
+    Tabulate the rows without parsing numbers out of the given text columns (e.g.
+    tickers that look like numbers)
+    """
+    rows = list(rows)
+    # tabulate fails to apply per-column settings to a table without any rows
+    if rows:
+        kwargs["disable_numparse"] = text_columns
+
+    return tabulate.tabulate(rows, headers=headers, **kwargs)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,43 @@
 import dataclasses
 import datetime
+import functools
+import os
+import pathlib
+import threading
+import time
+import typing as t
 
 import pandas
 import pandas_datareader
 import requests_cache
 
+_CACHE_EXPIRY = datetime.timedelta(days=1)
+
+# Parsed histories are cached as well as the raw API responses, so that runs within the
+# expiry period skip turning the JSON responses back into DataFrames
+_HISTORY_CACHE_DIR = pathlib.Path("tiingo-history-cache")
+
 
 @dataclasses.dataclass
 class AssetHistory:
     _historical_data: pandas.DataFrame
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def from_tiingo(cls, ticker: str) -> "AssetHistory":
-        tiingo_data = pandas_datareader.DataReader(
-            ticker,
-            data_source="tiingo",
-            session=_get_cached_tiingo_session(),
-        )
-        return cls(tiingo_data.loc[ticker])
+        cache_path = _HISTORY_CACHE_DIR / f"{ticker}.pkl"
+        historical_data = _read_cached_history(cache_path)
+
+        if historical_data is None:
+            tiingo_data = pandas_datareader.DataReader(
+                ticker,
+                data_source="tiingo",
+                session=_get_cached_tiingo_session(),
+            )
+            historical_data = tiingo_data.loc[ticker]
+            _write_cached_history(cache_path, historical_data)
+
+        return cls(historical_data)
 
     @property
     def data(self) -> pandas.DataFrame:
@@ -28,17 +48,79 @@ class AssetHistory:
         return previous_years_data.adjClose.resample("Y").ffill().pct_change()
 
     def get_annual_dividends(self) -> pandas.DataFrame:
+        return self._annual_dividends
+
+    def get_average_annual_dividend(self) -> float:
+        return self._average_annual_dividend
+
+    def get_previous_years_data(self) -> pandas.DataFrame:
+        return self._previous_years_data
+
+    # Histories are shared between callers (see from_tiingo) and the dividends are
+    # needed once per taxable account, so compute these derived frames only once
+    @functools.cached_property
+    def _annual_dividends(self) -> pandas.DataFrame:
         previous_years_data = self.get_previous_years_data()
         return previous_years_data.groupby(previous_years_data.index.year).divCash.sum()
 
-    def get_previous_years_data(self) -> pandas.DataFrame:
+    @functools.cached_property
+    def _average_annual_dividend(self) -> float:
+        return float(self.get_annual_dividends().mean())
+
+    @functools.cached_property
+    def _previous_years_data(self) -> pandas.DataFrame:
         this_year = datetime.datetime.now().year
-        return self._historical_data[self._historical_data.index.year < this_year]
+        years = self._historical_data.index.year.to_numpy()
+        return self._historical_data.iloc[years < this_year]
 
 
+@functools.lru_cache(maxsize=None)
 def _get_cached_tiingo_session() -> requests_cache.CachedSession:
     return requests_cache.CachedSession(
         cache_name="tiingo-api-cache",
         backend="sqlite",
-        expire_after=datetime.timedelta(days=1),
+        expire_after=_CACHE_EXPIRY,
     )
+
+
+def _read_cached_history(path: pathlib.Path) -> t.Optional[pandas.DataFrame]:
+    try:
+        age = time.time() - path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+    if age > _CACHE_EXPIRY.total_seconds():
+        return None
+
+    # Treat an unreadable or corrupt cache file as missing, so it just gets replaced
+    try:
+        return pandas.read_pickle(path)
+    except Exception:
+        return None
+
+
+def _write_cached_history(
+    path: pathlib.Path, historical_data: pandas.DataFrame
+) -> None:
+    """
+    Write to a temporary file and move it into place, so that readers never see a
+    partly written file, even when the same ticker is fetched by two threads at once.
+    The cache only saves refetching, so a history that can't be written is skipped.
+    """
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    try:
+        path.parent.mkdir(exist_ok=True)
+        historical_data.to_pickle(temp_path)
+        os.replace(temp_path, path)
+    except OSError:
+        _remove_temp_file(temp_path)
+    except BaseException:
+        _remove_temp_file(temp_path)
+        raise
+
+
+def _remove_temp_file(path: pathlib.Path) -> None:
+    try:
+        path.unlink(missing_ok=True)
+    except OSError:
+        pass
@@ -1,5 +1,7 @@
+import collections
 import datetime
 import enum
+import functools
 import typing as t
 
 import pydantic
@@ -26,7 +28,7 @@ class GoogleSheetDateTime(datetime.datetime):
         if not isinstance(value, int):
             raise TypeError("int required")
 
-        return cls.START_DATE + datetime.timedelta(days=value)
+        return _date_from_sheet_serial(value)
 
 
 class HoldTerm(enum.Enum):
@@ -50,10 +52,11 @@ class AssetLot(BaseModel):
 
     @property
     def hold_term(self) -> t.Optional[HoldTerm]:
-        if self.days_held is None:
+        days_held = self.days_held
+        if days_held is None:
             return None
 
-        return HoldTerm.LONG if self.days_held > 365 else HoldTerm.SHORT
+        return HoldTerm.LONG if days_held > 365 else HoldTerm.SHORT
 
 
 class Account(BaseModel):
@@ -64,6 +67,11 @@ class Account(BaseModel):
     cash_balance: float = pydantic.Field(0.0, ge=0.0)
     asset_lots: t.List[AssetLot] = pydantic.Field(default_factory=list)
 
+    _lots_by_ticker: t.Optional[t.Dict[str, t.List[AssetLot]]] = None
+    _shares_by_ticker: t.Optional[t.Dict[str, float]] = None
+    # The assets the total value was last calculated with, and that value
+    _total_value_cache: t.Optional[t.Tuple[t.Iterable[Asset], float]] = None
+
     @pydantic.validator("withdrawal_year")
     def _withdrawal_year_is_current_or_future(cls, withdrawal_year: int) -> int:
         this_year = datetime.datetime.now().year
@@ -86,17 +94,44 @@ class Account(BaseModel):
         return self.withdrawal_year - this_year
 
     def get_total_value(self, assets: t.Iterable[Asset]) -> float:
+        # Callers pass the same portfolio asset list every time, and neither the assets
+        # nor the lots change once loaded, so the value only needs calculating once
+        if self._total_value_cache is not None:
+            cached_assets, cached_total_value = self._total_value_cache
+            if cached_assets is assets:
+                return cached_total_value
+
         assets_by_ticker = {asset.ticker: asset for asset in assets}
         total_asset_value = sum(
             (lot.shares * assets_by_ticker[lot.ticker].share_price)
             for lot in self.asset_lots
         )
-        return self.cash_balance + total_asset_value
+        total_value = self.cash_balance + total_asset_value
+        self._total_value_cache = (assets, total_value)
+        return total_value
 
     def get_total_asset_shares(self, ticker: str) -> float:
-        return sum(lot.shares for lot in self.iterate_lots_for_asset(ticker))
+        if self._shares_by_ticker is None:
+            self._shares_by_ticker = {
+                lots_ticker: sum(lot.shares for lot in lots)
+                for lots_ticker, lots in self._get_lots_by_ticker().items()
+            }
+
+        return self._shares_by_ticker.get(ticker, 0.0)
 
     def iterate_lots_for_asset(self, ticker: str) -> t.Iterator[AssetLot]:
-        for lot in self.asset_lots:
-            if lot.ticker == ticker:
-                yield lot
+        return iter(self._get_lots_by_ticker().get(ticker, []))
+
+    def _get_lots_by_ticker(self) -> t.Dict[str, t.List[AssetLot]]:
+        if self._lots_by_ticker is None:
+            self._lots_by_ticker = collections.defaultdict(list)
+            for lot in self.asset_lots:
+                self._lots_by_ticker[lot.ticker].append(lot)
+
+        return self._lots_by_ticker
+
+
+# Lots bought on the same day share a serial date, so each one is only converted once
+@functools.lru_cache(maxsize=None)
+def _date_from_sheet_serial(days: int) -> datetime.datetime:
+    return GoogleSheetDateTime.START_DATE + datetime.timedelta(days=days)
@@ -37,7 +37,7 @@ class Asset(BaseModel):
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, Asset):
             raise NotImplementedError
-        return self.ticker != other.ticker
+        return self.ticker == other.ticker
 
     def __hash__(self) -> int:
         return hash(self.ticker)
@@ -9,4 +9,7 @@ class BaseModel(pydantic.BaseModel):
     class Config:
         alias_generator = _to_title
         allow_population_by_field_name = True
+        # Models are derived from the sheet and never change afterwards, which lets them
+        # cache values calculated from their fields
+        allow_mutation = False
         underscore_attrs_are_private = True
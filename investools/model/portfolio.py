@@ -1,3 +1,4 @@
+import math
 import typing as t
 
 import pydantic
@@ -15,6 +16,15 @@ class Portfolio(BaseModel):
     assets: t.List[Asset]
     config: Config
 
+    _assets_by_allocation: t.Dict[str, t.List[Asset]]
+    _allocations_by_asset_ticker: t.Dict[str, t.List[Allocation]]
+
+    def __init__(self, **data: t.Any) -> None:
+        super().__init__(**data)
+        # Allocations and assets don't change once loaded, so work out which assets each
+        # allocation matches up front rather than every time it is needed
+        self._index_allocation_matches()
+
     @pydantic.validator("allocations")
     def _allocation_proportions_sum_to_one(
         cls, allocations: t.List[Allocation]
@@ -22,12 +32,35 @@ class Portfolio(BaseModel):
         if not allocations:
             return allocations
 
-        proportions_sum = sum(allocation.proportion for allocation in allocations)
+        proportions_sum = math.fsum(allocation.proportion for allocation in allocations)
 
-        if proportions_sum != 1:
+        # Proportions are entered as decimals in the sheet, so allow for float error
+        if not math.isclose(proportions_sum, 1, abs_tol=1e-9):
             raise ValueError(f"Sum of proportions is {proportions_sum}; must be 1")
 
         return allocations
 
     def get_total_value(self) -> float:
         return sum(account.get_total_value(self.assets) for account in self.accounts)
+
+    def get_matching_assets(self, allocation: Allocation) -> t.List[Asset]:
+        return self._assets_by_allocation[allocation.id]
+
+    def get_matching_allocations(self, asset: Asset) -> t.List[Allocation]:
+        return self._allocations_by_asset_ticker.get(asset.ticker, [])
+
+    def _index_allocation_matches(self) -> None:
+        assets_by_allocation: t.Dict[str, t.List[Asset]] = {
+            allocation.id: [] for allocation in self.allocations
+        }
+        allocations_by_asset_ticker: t.Dict[str, t.List[Allocation]] = {
+            asset.ticker: [] for asset in self.assets
+        }
+        for allocation in self.allocations:
+            for asset in self.assets:
+                if allocation.matches(asset):
+                    assets_by_allocation[allocation.id].append(asset)
+                    allocations_by_asset_ticker[asset.ticker].append(allocation)
+
+        self._assets_by_allocation = assets_by_allocation
+        self._allocations_by_asset_ticker = allocations_by_asset_ticker
@@ -1,12 +1,26 @@
+import collections
 import dataclasses
 import enum
 import functools
 import itertools
+import json
+import math
+import os
+import pathlib
 import typing as t
 
 import pulp
 
-from . import model, returns, utils
+from . import model, utils
+
+# Stop searching once the solution is provably within this fraction of the optimum
+_MAX_RELATIVE_GAP = 0.0001
+
+# Relaxed share counts this close to a whole number are considered whole
+_SHARE_ROUNDING_TOLERANCE = 1e-6
+
+# The most recent solution is saved here to use as a starting point for the next run
+_PREVIOUS_SOLUTION_PATH = pathlib.Path("rebalance-solution.json")
 
 
 class AllowedSales(enum.Enum):
@@ -16,6 +30,13 @@ class AllowedSales(enum.Enum):
     ALL = "all"
 
 
+class Solver(enum.Enum):
+    AUTO = "auto"
+    HIGHS = "highs"
+    CBC = "cbc"
+    GUROBI = "gurobi"
+
+
 @dataclasses.dataclass
 class Sale:
     share_count: float
@@ -83,9 +104,7 @@ class Position:
         )
 
     def _iter_asset_lots(self) -> t.Iterator[model.AssetLot]:
-        for lot in self.account.asset_lots:
-            if lot.ticker == self.asset.ticker:
-                yield lot
+        return self.account.iterate_lots_for_asset(self.asset.ticker)
 
     def generate_sales(self, allowed: AllowedSales) -> t.Iterator[Sale]:
         delta = self.get_delta()
@@ -137,50 +156,112 @@ def rebalance(
     portfolio: model.Portfolio,
     allowed_sales: AllowedSales,
     max_time: int,
+    fast: bool = False,
+    solver: Solver = Solver.AUTO,
+    verbose: bool = False,
 ) -> t.List[Position]:
-    drift_limit = 0.0001
-    while True:
+    lp_solver = _get_solver(solver, max_time, verbose)
+    return_rates = _get_projected_return_rates(portfolio)
+
+    # The positions and their LP variables don't depend on the drift limit, so create
+    # them once and reuse them for every attempt
+    positions = [
+        Position(account, asset)
+        for account in portfolio.accounts
+        for asset in portfolio.assets
+    ]
+    previous_target_shares = _load_previous_target_shares()
+
+    positions_by_account: t.Dict[str, t.List[Position]] = collections.defaultdict(list)
+    positions_by_ticker: t.Dict[str, t.List[Position]] = collections.defaultdict(list)
+    for position in positions:
+        positions_by_account[position.account.id].append(position)
+        positions_by_ticker[position.asset.ticker].append(position)
+
+    # Only the drift limit changes between attempts, so build the problem once and just
+    # move the bounds of its drift constraints each time
+    problem, drift_constraints = _build_problem(
+        portfolio,
+        positions,
+        positions_by_account,
+        positions_by_ticker,
+        return_rates,
+        allowed_sales,
+    )
+
+    if fast and _try_fast_rebalance(
+        problem,
+        portfolio,
+        positions,
+        positions_by_account,
+        drift_constraints,
+        return_rates,
+        lp_solver,
+    ):
+        _save_target_shares(positions)
+        return positions
+
+    for drift_limit in _iterate_drift_limits(portfolio.config.drift_limit):
+        _set_drift_limit(portfolio, drift_constraints, drift_limit)
         try:
-            return _try_rebalance(portfolio, drift_limit, allowed_sales, max_time)
+            _try_rebalance(
+                problem,
+                positions,
+                previous_target_shares,
+                lp_solver,
+            )
+            break
         except CannotRebalance:
-            drift_limit = drift_limit * 2
-            if drift_limit > portfolio.config.drift_limit:
-                raise
+            pass
+    else:
+        raise CannotRebalance()
+
+    _save_target_shares(positions)
+    return positions
 
 
-def _try_rebalance(
+def _build_problem(
     portfolio: model.Portfolio,
-    drift_limit: float,
+    positions: t.List[Position],
+    positions_by_account: t.Mapping[str, t.List[Position]],
+    positions_by_ticker: t.Mapping[str, t.List[Position]],
+    return_rates: t.Mapping[t.Tuple[str, str], float],
     allowed_sales: AllowedSales,
-    max_time: int,
-) -> t.List[Position]:
+) -> t.Tuple[
+    pulp.LpProblem, t.Dict[str, t.Tuple[pulp.LpConstraint, pulp.LpConstraint]]
+]:
+    """
+    Build the rebalancing problem, along with the positive and negative drift limit
+    constraints of each allocation keyed by allocation ID, whose bounds are left to be
+    set by _set_drift_limit
+    """
     problem = pulp.LpProblem(name="Rebalance", sense=pulp.const.LpMaximize)
 
-    positions = [
-        Position(account, asset)
+    total_value_by_account = {
+        account.id: account.get_total_value(portfolio.assets)
         for account in portfolio.accounts
-        for asset in portfolio.assets
-    ]
+    }
 
     # Ensure the total investment in every account does not exceed its current value
     for account in portfolio.accounts:
-        total_account_value = account.get_total_value(portfolio.assets)
+        total_account_value = total_value_by_account[account.id]
 
-        account_positions = [
-            position for position in positions if position.account.id == account.id
-        ]
+        account_positions = positions_by_account[account.id]
 
-        account_investments = [
-            position.target_shares_variable * position.asset.share_price
-            for position in account_positions
-        ]
+        # Build linear expressions from (variable, coefficient) pairs in one go rather
+        # than summing per-position expressions, which copies the sum on every add
+        account_investment = pulp.LpAffineExpression(
+            [
+                (position.target_shares_variable, position.asset.share_price)
+                for position in account_positions
+            ]
+        )
 
         problem += (
-            pulp.lpSum(account_investments) <= total_account_value,
+            account_investment <= total_account_value,
             f"investments_dont_exceed_value_account_{account.id}",
         )
 
-    # Ensure each allocation is within the drift limit of its target proportion
     total_portfolio_value = portfolio.get_total_value()
 
     # If this limit is configured, ensure that all accounts within the same taxation
@@ -199,68 +280,67 @@ def _try_rebalance(
                     assert isinstance(first_account, model.Account)
                     assert isinstance(second_account, model.Account)
 
-                    first_account_positions = {
-                        position.asset.ticker: position
-                        for position in positions
-                        if position.account.id == first_account.id
-                    }
-                    for position in positions:
-                        if position.account.id == second_account.id:
-                            asset = position.asset
-                            first_account_position = first_account_positions[
-                                asset.ticker
+                    # Every account has one position per asset, in the same order
+                    for first_account_position, second_account_position in zip(
+                        positions_by_account[first_account.id],
+                        positions_by_account[second_account.id],
+                    ):
+                        asset = first_account_position.asset
+
+                        # The difference between the percentages of each account's
+                        # value held in this asset
+                        difference = pulp.LpAffineExpression(
+                            [
+                                (
+                                    first_account_position.target_shares_variable,
+                                    asset.share_price
+                                    / total_value_by_account[first_account.id],
+                                ),
+                                (
+                                    second_account_position.target_shares_variable,
+                                    -asset.share_price
+                                    / total_value_by_account[second_account.id],
+                                ),
                             ]
-                            second_account_position = position
-
-                            first_account_position_percentage = (
-                                first_account_position.target_shares_variable
-                                * asset.share_price
-                            ) / first_account.get_total_value(portfolio.assets)
-
-                            second_account_position_percentage = (
-                                second_account_position.target_shares_variable
-                                * asset.share_price
-                            ) / second_account.get_total_value(portfolio.assets)
-
-                            difference = (
-                                first_account_position_percentage
-                                - second_account_position_percentage
-                            )
-
-                            problem += (
-                                difference
-                                <= portfolio.config.same_tax_class_drift_limit,
-                                f"same_tax_class_drift_within_positive_limit_{first_account.id}_{second_account.id}_{asset.ticker}",
-                            )
-                            problem += (
-                                -difference
-                                <= portfolio.config.same_tax_class_drift_limit,
-                                f"same_tax_class_drift_within_negative_limit_{first_account.id}_{second_account.id}_{asset.ticker}",
-                            )
+                        )
 
-    for allocation in portfolio.allocations:
-        matching_asset_tickers = {
-            asset.ticker for asset in portfolio.assets if allocation.matches(asset)
-        }
-
-        matching_asset_investments = [
-            position.target_shares_variable * position.asset.share_price
-            for position in positions
-            if position.asset.ticker in matching_asset_tickers
-        ]
+                        problem += (
+                            difference <= portfolio.config.same_tax_class_drift_limit,
+                            f"same_tax_class_drift_within_positive_limit_{first_account.id}_{second_account.id}_{asset.ticker}",
+                        )
+                        problem += (
+                            -difference <= portfolio.config.same_tax_class_drift_limit,
+                            f"same_tax_class_drift_within_negative_limit_{first_account.id}_{second_account.id}_{asset.ticker}",
+                        )
 
-        matching_assets_total_investment = pulp.lpSum(matching_asset_investments)
+    # Ensure each allocation is within the drift limit of its target proportion
+    drift_constraints = {}
+    for allocation in portfolio.allocations:
+        matching_assets_total_investment = pulp.LpAffineExpression(
+            [
+                (position.target_shares_variable, position.asset.share_price)
+                for asset in portfolio.get_matching_assets(allocation)
+                for position in positions_by_ticker[asset.ticker]
+            ]
+        )
         matching_assets_proportion = (
             matching_assets_total_investment / total_portfolio_value
         )
-        matching_assets_drift = allocation.proportion - matching_assets_proportion
-        problem += (
-            matching_assets_drift <= drift_limit,
-            f"drift_within_positive_limit_allocation_{allocation.id}",
+        positive_drift_constraint = pulp.LpConstraint(
+            -matching_assets_proportion,
+            sense=pulp.const.LpConstraintLE,
+            name=f"drift_within_positive_limit_allocation_{allocation.id}",
         )
-        problem += (
-            -matching_assets_drift <= drift_limit,
-            f"drift_within_negative_limit_allocation_{allocation.id}",
+        negative_drift_constraint = pulp.LpConstraint(
+            matching_assets_proportion,
+            sense=pulp.const.LpConstraintLE,
+            name=f"drift_within_negative_limit_allocation_{allocation.id}",
+        )
+        problem += positive_drift_constraint
+        problem += negative_drift_constraint
+        drift_constraints[allocation.id] = (
+            positive_drift_constraint,
+            negative_drift_constraint,
         )
 
     # Constrain based on allowed sale type
@@ -289,61 +369,337 @@ def _try_rebalance(
                     f"no_short_term_sales_account_{position.account.id}_asset_{position.asset.ticker}",
                 )
 
-    projected_position_return_variables = _get_projected_position_return_variables(
-        portfolio, positions
+    projected_portfolio_return = pulp.LpAffineExpression(
+        [
+            (
+                position.target_shares_variable,
+                position.asset.share_price
+                * return_rates[(position.account.id, position.asset.ticker)],
+            )
+            for position in positions
+        ]
     )
-    problem += pulp.lpSum(projected_position_return_variables)
+    problem += projected_portfolio_return
+
+    return problem, drift_constraints
+
+
+def _set_drift_limit(
+    portfolio: model.Portfolio,
+    drift_constraints: t.Mapping[str, t.Tuple[pulp.LpConstraint, pulp.LpConstraint]],
+    drift_limit: float,
+) -> None:
+    """
+    Move the bounds of every allocation's drift constraints to the given limit
+    """
+    for allocation in portfolio.allocations:
+        positive_drift_constraint, negative_drift_constraint = drift_constraints[
+            allocation.id
+        ]
+        # The drift is the target proportion minus the matching assets' proportion
+        positive_drift_constraint.changeRHS(drift_limit - allocation.proportion)
+        negative_drift_constraint.changeRHS(drift_limit + allocation.proportion)
+
+
+def _iterate_drift_limits(max_drift_limit: float) -> t.Iterator[float]:
+    """
+    Generate increasingly loose drift limits to try, starting with a very tight one and
+    doubling it each time for as long as it stays within the maximum
+    """
+    drift_limit = 0.0001
+    while True:
+        yield drift_limit
+        drift_limit = drift_limit * 2
+        if drift_limit > max_drift_limit:
+            return
 
-    solver = pulp.get_solver("PULP_CBC_CMD", timeLimit=max_time)
-    problem.solve(solver=solver)
+
+def _try_fast_rebalance(
+    problem: pulp.LpProblem,
+    portfolio: model.Portfolio,
+    positions: t.List[Position],
+    positions_by_account: t.Mapping[str, t.List[Position]],
+    drift_constraints: t.Mapping[str, t.Tuple[pulp.LpConstraint, pulp.LpConstraint]],
+    return_rates: t.Mapping[t.Tuple[str, str], float],
+    lp_solver: pulp.LpSolver,
+) -> bool:
+    """
+    Solve with fractional shares, which is much quicker than solving for whole shares
+    directly, then round the result to whole shares. Try each drift limit in turn until
+    the rounded solution satisfies the problem. Returns whether one did; if not, the
+    problem is left to be solved for whole shares.
+    """
+    for position in positions:
+        position.target_shares_variable.cat = pulp.const.LpContinuous
+
+    try:
+        for drift_limit in _iterate_drift_limits(portfolio.config.drift_limit):
+            _set_drift_limit(portfolio, drift_constraints, drift_limit)
+            problem.solve(solver=lp_solver)
+
+            if problem.status == 1 and _round_target_shares(
+                problem, portfolio, positions_by_account, return_rates
+            ):
+                return True
+    finally:
+        for position in positions:
+            position.target_shares_variable.cat = pulp.const.LpInteger
+
+    return False
+
+
+def _try_rebalance(
+    problem: pulp.LpProblem,
+    positions: t.List[Position],
+    previous_target_shares: t.Mapping[str, float],
+    lp_solver: pulp.LpSolver,
+) -> None:
+    # Start the search from a feasible solution if there is one at hand, so that the
+    # solver can prune much of the search early. Prefer the previous run's solution,
+    # then the current holdings (which are that solution once its trades are made).
+    current_target_shares = {
+        position.target_shares_variable.name: math.floor(position.get_current_shares())
+        for position in positions
+    }
+    for initial_target_shares in (previous_target_shares, current_target_shares):
+        for position in positions:
+            variable = position.target_shares_variable
+            variable.setInitialValue(
+                initial_target_shares.get(
+                    variable.name, current_target_shares[variable.name]
+                )
+            )
+
+        if _is_solution_valid(problem):
+            break
+
+    problem.solve(solver=lp_solver)
 
     if problem.status != 1:
         raise CannotRebalance()
 
-    return positions
+
+def _round_target_shares(
+    problem: pulp.LpProblem,
+    portfolio: model.Portfolio,
+    positions_by_account: t.Mapping[str, t.List[Position]],
+    return_rates: t.Mapping[t.Tuple[str, str], float],
+) -> bool:
+    """
+    Round the solved target shares of every position down to whole shares, then spend
+    whatever that frees up in each account one share at a time. Each share goes to the
+    position that most reduces how far the rounding pushed the constraints out of bounds,
+    or else to the highest-returning one that adds to the projected return, and never
+    makes any constraint worse. Returns whether the rounded solution satisfies the
+    problem.
+    """
+    for position in itertools.chain.from_iterable(positions_by_account.values()):
+        variable = position.target_shares_variable
+        variable.varValue = float(
+            math.floor(variable.varValue + _SHARE_ROUNDING_TOLERANCE)
+        )
+
+    # Track the value of every constraint so that the effect of buying a share can be
+    # worked out from its coefficients instead of evaluating the whole problem again
+    constraint_values = {
+        name: constraint.value() for name, constraint in problem.constraints.items()
+    }
+    coefficients_by_variable: t.Dict[
+        str, t.List[t.Tuple[str, float]]
+    ] = collections.defaultdict(list)
+    for name, constraint in problem.constraints.items():
+        for variable, coefficient in constraint.items():
+            coefficients_by_variable[variable.name].append((name, coefficient))
+
+    for account in portfolio.accounts:
+        while True:
+            best_position = None
+            best_key = None
+            for position in positions_by_account[account.id]:
+                reduction = 0.0
+                for name, coefficient in coefficients_by_variable[
+                    position.target_shares_variable.name
+                ]:
+                    sense = problem.constraints[name].sense
+                    value = constraint_values[name]
+                    change = _get_violation(sense, value) - _get_violation(
+                        sense, value + coefficient
+                    )
+                    if change < 0:
+                        break
+                    reduction += change
+                else:
+                    return_rate = return_rates[(account.id, position.asset.ticker)]
+                    # A share that neither repairs a constraint nor adds to the return
+                    # isn't worth buying, and one that costs nothing would be bought
+                    # forever
+                    if reduction <= 0 and position.asset.share_price * return_rate <= 0:
+                        continue
+
+                    key = (reduction, return_rate)
+                    if best_key is None or key > best_key:
+                        best_position = position
+                        best_key = key
+
+            if best_position is None:
+                break
+
+            variable = best_position.target_shares_variable
+            variable.varValue += 1
+            for name, coefficient in coefficients_by_variable[variable.name]:
+                constraint_values[name] += coefficient
+
+    return _is_solution_valid(problem)
+
+
+def _get_violation(sense: int, value: float) -> float:
+    """
+    How far a constraint with the given sense is out of bounds when its left-hand side
+    minus its right-hand side has the given value
+    """
+    if sense == pulp.const.LpConstraintEQ:
+        return abs(value)
+
+    return max(0.0, -value * sense)
+
+
+def _is_solution_valid(problem: pulp.LpProblem) -> bool:
+    return all(
+        constraint.valid(eps=_SHARE_ROUNDING_TOLERANCE)
+        for constraint in problem.constraints.values()
+    )
 
 
-def _get_projected_position_return_variables(
+def _get_solver(solver: Solver, max_time: int, verbose: bool) -> pulp.LpSolver:
+    """
+    Unless told otherwise, prefer HiGHS, which is typically much faster than CBC on small
+    integer programs like this one, but it must be installed separately so fall back to
+    PuLP's bundled CBC
+    """
+    if solver is Solver.AUTO:
+        try:
+            return _get_solver(Solver.HIGHS, max_time, verbose)
+        except SolverNotAvailable:
+            return _get_solver(Solver.CBC, max_time, verbose)
+
+    if solver is Solver.HIGHS:
+        # HiGHS already stops at the max relative gap by default, but unlike the others
+        # it doesn't accept a starting solution (see _try_rebalance)
+        lp_solver = pulp.get_solver("HiGHS_CMD", msg=verbose, timeLimit=max_time)
+    elif solver is Solver.GUROBI:
+        lp_solver = pulp.get_solver(
+            "GUROBI_CMD",
+            msg=verbose,
+            timeLimit=max_time,
+            gapRel=_MAX_RELATIVE_GAP,
+            warmStart=True,
+        )
+    else:
+        # CBC only searches the branch-and-bound tree on one thread unless asked to
+        lp_solver = pulp.get_solver(
+            "PULP_CBC_CMD",
+            msg=verbose,
+            timeLimit=max_time,
+            gapRel=_MAX_RELATIVE_GAP,
+            warmStart=True,
+            threads=os.cpu_count(),
+        )
+
+    if not lp_solver.available():
+        raise SolverNotAvailable(solver)
+
+    return lp_solver
+
+
+def _load_previous_target_shares() -> t.Dict[str, float]:
+    try:
+        previous_target_shares = json.loads(_PREVIOUS_SOLUTION_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+    # Ignore anything that isn't a solution saved by _save_target_shares
+    if not isinstance(previous_target_shares, dict):
+        return {}
+
+    # Share counts must also be within the bounds of their variables, which start at 0
+    return {
+        name: shares
+        for name, shares in previous_target_shares.items()
+        if isinstance(shares, (int, float))
+        and not isinstance(shares, bool)
+        and math.isfinite(shares)
+        and shares >= 0
+    }
+
+
+def _save_target_shares(positions: t.Iterable[Position]) -> None:
+    target_shares = {
+        position.target_shares_variable.name: position.get_target_shares()
+        for position in positions
+    }
+    # The saved solution only speeds up the next run, so carry on without it if it can't
+    # be written
+    try:
+        _PREVIOUS_SOLUTION_PATH.write_text(json.dumps(target_shares))
+    except OSError:
+        pass
+
+
+def _get_projected_return_rates(
     portfolio: model.Portfolio,
-    positions: t.List[Position],
-) -> t.List[pulp.LpVariable]:
+) -> t.Dict[t.Tuple[str, str], float]:
+    """
+    Project the post-tax return rate of every asset in every account, keyed by account
+    ID and ticker
+    """
+    # Imported here because it pulls in pandas and pandas_datareader, which are slow
+    # to import and not needed by the rest of this module
+    from . import returns
+
     tax_exempt_return_rates_by_asset = returns.project_tax_exempt_rates(
         portfolio.assets
     )
-    project_return_variables = []
-    for position in positions:
-        asset = position.asset
-
-        tax_exempt_return_rate = tax_exempt_return_rates_by_asset[asset.ticker]
-        if position.account.taxation_class is model.TaxationClass.TAXABLE:
-            return_rate = returns.project_taxable_rate(
-                asset,
-                tax_exempt_return_rate,
-                position.account.get_years_until_withdrawal(),
-                portfolio.config.ordinary_tax_rate,
-                portfolio.config.preferential_tax_rate,
-            )
-        elif position.account.taxation_class is model.TaxationClass.TAX_DEFERRED:
-            tax_rate = (
-                portfolio.config.ordinary_tax_rate
-                if position.account.withdrawal_tax_rate is None
-                else position.account.withdrawal_tax_rate
-            )
-            return_rate = returns.project_tax_deferred_rate(
-                asset,
-                tax_exempt_return_rate,
-                position.account.get_years_until_withdrawal(),
-                tax_rate,
-            )
-        else:
-            return_rate = tax_exempt_return_rate
+    return_rates = {}
+    for account in portfolio.accounts:
+        years_until_withdrawal = account.get_years_until_withdrawal()
+        for asset in portfolio.assets:
+            tax_exempt_return_rate = tax_exempt_return_rates_by_asset[asset.ticker]
+            if account.taxation_class is model.TaxationClass.TAXABLE:
+                return_rate = returns.project_taxable_rate(
+                    asset,
+                    tax_exempt_return_rate,
+                    years_until_withdrawal,
+                    portfolio.config.ordinary_tax_rate,
+                    portfolio.config.preferential_tax_rate,
+                )
+            elif account.taxation_class is model.TaxationClass.TAX_DEFERRED:
+                tax_rate = (
+                    portfolio.config.ordinary_tax_rate
+                    if account.withdrawal_tax_rate is None
+                    else account.withdrawal_tax_rate
+                )
+                return_rate = returns.project_tax_deferred_rate(
+                    asset,
+                    tax_exempt_return_rate,
+                    years_until_withdrawal,
+                    tax_rate,
+                )
+            else:
+                return_rate = tax_exempt_return_rate
 
-        project_return_variables.append(
-            position.target_shares_variable * asset.share_price * return_rate
-        )
-    return project_return_variables
+            return_rates[(account.id, asset.ticker)] = return_rate
+    return return_rates
 
 
 class CannotRebalance(Exception):
     def __str__(self) -> str:
         return "The portfolio cannot be rebalanced with the given constraints"
+
+
+class SolverNotAvailable(Exception):
+    def __init__(self, solver: Solver):
+        super().__init__(solver)
+        self.solver = solver
+
+    def __str__(self) -> str:
+        return f"The {self.solver.value} solver is not installed"
@@ -1,29 +1,34 @@
+import concurrent.futures
 import typing as t
-import warnings
 
+import numpy
 import pandas
 
 from investools import history, model
 
+# Tiingo fetches are I/O-bound, so they can be issued concurrently
+_MAX_FETCH_WORKERS = 16
+
 
 def project_tax_exempt_rates(
     assets: t.Iterable[model.Asset],
     total_market_asset_ticker: str = "ACWI",
 ) -> t.Dict[str, float]:
-    market_history = history.AssetHistory.from_tiingo(total_market_asset_ticker)
+    assets = list(assets)
+    asset_histories_by_ticker = _fetch_histories(
+        [total_market_asset_ticker] + [asset.ticker for asset in assets]
+    )
+    market_history = asset_histories_by_ticker[total_market_asset_ticker]
     market_prices = market_history.data.adjClose
     risk_aversion = _get_market_implied_risk_aversion(market_prices)
-
     market_caps_by_asset = {
         asset.ticker: asset.get_market_capitalization() for asset in assets
     }
     annual_returns_by_asset = {
-        asset.ticker: history.AssetHistory.from_tiingo(
-            asset.ticker
-        ).get_annual_returns()
+        asset.ticker: asset_histories_by_ticker[asset.ticker].get_annual_returns()
         for asset in assets
     }
-    covariance_matrix = pandas.DataFrame(annual_returns_by_asset).cov()
+    covariance_matrix = _get_covariance_matrix(annual_returns_by_asset)
 
     return _get_market_implied_prior_returns(
         market_caps_by_asset, risk_aversion, covariance_matrix
@@ -58,8 +63,7 @@ def project_taxable_rate(
     See "Deriving Account-Specific After-Tax Return" #3
     """
     asset_history = history.AssetHistory.from_tiingo(asset.ticker)
-    average_annual_dividend = asset_history.get_annual_dividends().mean()
-
+    average_annual_dividend = asset_history.get_average_annual_dividend()
     qualified_dividends = average_annual_dividend * asset.qdi
     unqualified_dividends = average_annual_dividend - qualified_dividends
     dividend_taxes = (
@@ -73,7 +77,6 @@ def project_taxable_rate(
     # factor in dividends, so this rate includes growth resulting from dividends
     post_tax_annual_return = annual_return - dividend_taxes
     adjusted_annual_return_rate = post_tax_annual_return / current_value
-
     return _get_annualized_post_tax_return_rate(
         current_value,
         adjusted_annual_return_rate,
@@ -95,6 +98,37 @@ def _get_annualized_post_tax_return_rate(
     return (projected_post_tax_value / current_value) ** (1 / years) - 1
 
 
+def _fetch_histories(tickers: t.List[str]) -> t.Dict[str, history.AssetHistory]:
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=_MAX_FETCH_WORKERS
+    ) as executor:
+        return dict(
+            zip(tickers, executor.map(history.AssetHistory.from_tiingo, tickers))
+        )
+
+
+def _get_covariance_matrix(
+    annual_returns_by_asset: t.Mapping[str, pandas.Series],
+) -> pandas.DataFrame:
+    """
+    Equivalent to pandas.DataFrame.cov, which only uses the years that both assets in
+    each pair have returns for, but computed with a few matrix products over the whole
+    returns matrix rather than column pair by column pair
+    """
+    annual_returns = pandas.DataFrame(annual_returns_by_asset)
+    has_value = annual_returns.notna().astype(float)
+    values = annual_returns.fillna(0.0)
+    # For each pair of assets (i, j), using only the years they both have returns for:
+    # the number of years, the sum of i's returns, and the sum of products of returns
+    pair_counts = has_value.T @ has_value
+    pair_sums = values.T @ has_value
+    pair_product_sums = values.T @ values
+    covariance = (pair_product_sums - pair_sums * pair_sums.T / pair_counts) / (
+        pair_counts - 1
+    )
+    return covariance.where(pair_counts > 1)
+
+
 # Both functions below completely jacked from here:
 # https://github.com/robertmartin8/PyPortfolioOpt/blob/master/pypfopt/black_litterman.py
 
@@ -124,9 +158,14 @@ def _get_market_implied_risk_aversion(
     :return: market-implied risk aversion
     :rtype: float
     """
-    rets = market_prices.pct_change().dropna()
+    # Work on the underlying array, which avoids the intermediate Series that
+    # pct_change() and dropna() allocate. Fill in missing prices and drop the returns
+    # that still can't be calculated, as those would otherwise make every result NaN.
+    prices = market_prices.ffill().to_numpy()
+    rets = prices[1:] / prices[:-1] - 1
+    rets = rets[numpy.isfinite(rets)]
     rate = float(rets.mean() * frequency)
-    var = float(rets.var() * frequency)
+    var = float(rets.var(ddof=1) * frequency)
     return (rate - risk_free_rate) / var
 
 
@@ -146,7 +185,8 @@ def _get_market_implied_prior_returns(
     :type market_caps: {ticker: cap} dict or pandas.Series
     :param risk_aversion: risk aversion parameter
     :type risk_aversion: positive float
-    :param cov_matrix: covariance matrix of asset returns
+    :param cov_matrix: covariance matrix of asset returns, labelled by ticker so
+                       that the market caps can be lined up with it
     :type cov_matrix: pandas.DataFrame
     :param risk_free_rate: risk-free rate of borrowing/lending, defaults to 0.02.
                            You should use the appropriate time period, corresponding
@@ -155,13 +195,11 @@ def _get_market_implied_prior_returns(
     :return: prior estimate of returns as implied by the market caps
     :rtype: dict
     """
-    if not isinstance(cov_matrix, pandas.DataFrame):
-        warnings.warn(
-            "If cov_matrix is not a dataframe, market cap index must be aligned to cov_matrix",
-            RuntimeWarning,
-        )
-    mcaps = pandas.Series(market_caps)
-    mkt_weights = mcaps / mcaps.sum()
+    # Read the caps in the covariance matrix's order and multiply the underlying array
+    # directly, rather than building Series just to have pandas align them
+    mcaps = [market_caps[ticker] for ticker in cov_matrix.columns]
+    total_mcap = sum(mcaps)
+    mkt_weights = [mcap / total_mcap for mcap in mcaps]
     # Pi is excess returns so must add risk_free_rate to get return.
-    returns_as_series = risk_aversion * cov_matrix.dot(mkt_weights) + risk_free_rate
-    return dict(returns_as_series)
+    returns = risk_aversion * (cov_matrix.to_numpy() @ mkt_weights) + risk_free_rate
+    return dict(zip(cov_matrix.index, returns.tolist()))
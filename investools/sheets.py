@@ -6,38 +6,78 @@ from investools import model
 
 _GOOGLE_OAUTH_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
+_REQUIRED_WORKSHEET_TITLES = ["Allocations", "Accounts", "Assets", "Config"]
+_LOTS_WORKSHEET_TITLE_PREFIX = "Lots: "
+
 
 def get_client() -> gspread.Client:
     return gspread.oauth(scopes=_GOOGLE_OAUTH_SCOPES)
 
 
 def build_portfolio(sheet: gspread.Spreadsheet) -> model.Portfolio:
-    data = {
-        worksheet_title: sheet.worksheet(worksheet_title).get_all_records(
-            value_render_option="UNFORMATTED_VALUE"
-        )
+    # Fetching each worksheet separately takes a few requests per worksheet, so list
+    # the worksheets once and then fetch all of the needed ones in a single request
+    worksheet_titles = [worksheet.title for worksheet in sheet.worksheets()]
+    for required_title in _REQUIRED_WORKSHEET_TITLES:
+        if required_title not in worksheet_titles:
+            raise gspread.exceptions.WorksheetNotFound(required_title)
+
+    values_by_title = _batch_get_values(
+        sheet,
+        [
+            title
+            for title in worksheet_titles
+            if title in _REQUIRED_WORKSHEET_TITLES
+            or title.startswith(_LOTS_WORKSHEET_TITLE_PREFIX)
+        ],
+    )
+
+    data: t.Dict[str, t.Any] = {
+        worksheet_title: _values_to_records(values_by_title[worksheet_title])
         for worksheet_title in ["Allocations", "Accounts", "Assets"]
     }
     for account_record in data["Accounts"]:
         name = account_record["Name"]
-        try:
-            lots_worksheet = sheet.worksheet(f"Lots: {name}")
-        except gspread.exceptions.WorksheetNotFound:
-            lot_records = []
-        else:
-            lot_records = lots_worksheet.get_all_records(
-                value_render_option="UNFORMATTED_VALUE"
-            )
-        account_record["Asset Lots"] = lot_records
-
-    config_worksheet = sheet.worksheet("Config")
-    data["Config"] = _rows_to_dict(config_worksheet)
+        account_record["Asset Lots"] = _values_to_records(
+            values_by_title.get(f"{_LOTS_WORKSHEET_TITLE_PREFIX}{name}", [])
+        )
+
+    data["Config"] = _rows_to_dict(values_by_title["Config"])
 
     return model.Portfolio.parse_obj(data)
 
 
-def _rows_to_dict(worksheet: gspread.Worksheet) -> t.Dict[t.Any, t.Any]:
+def _batch_get_values(
+    sheet: gspread.Spreadsheet, worksheet_titles: t.List[str]
+) -> t.Dict[str, t.List[t.List[t.Any]]]:
+    response = sheet.values_batch_get(
+        [gspread.utils.absolute_range_name(title) for title in worksheet_titles],
+        params={"valueRenderOption": "UNFORMATTED_VALUE"},
+    )
+    # Value ranges come back in the order they were requested, without any values at
+    # all for empty worksheets
     return {
-        row[0]: row[1]
-        for row in worksheet.get_all_values(value_render_option="UNFORMATTED_VALUE")
+        title: gspread.utils.fill_gaps(value_range.get("values", []))
+        for title, value_range in zip(worksheet_titles, response["valueRanges"])
     }
+
+
+def _values_to_records(values: t.List[t.List[t.Any]]) -> t.List[t.Dict[str, t.Any]]:
+    """
+    Equivalent to gspread.Worksheet.get_all_records, using the first row as the keys
+    """
+    if len(values) < 2:
+        return []
+
+    keys, *rows = values
+    # Duplicate keys would silently overwrite each other's values
+    if len(keys) != len(set(keys)):
+        raise gspread.exceptions.GSpreadException(
+            "the header row in the worksheet is not unique"
+        )
+
+    return [dict(zip(keys, gspread.utils.numericise_all(row))) for row in rows]
+
+
+def _rows_to_dict(values: t.List[t.List[t.Any]]) -> t.Dict[t.Any, t.Any]:
+    return {row[0]: row[1] for row in values}
@@ -0,0 +1,191 @@
+import datetime
+import json
+import pathlib
+import tempfile
+import typing as t
+import unittest
+from unittest import mock
+
+import pulp
+
+from investools import model, rebalancing
+
+
+def _make_portfolio(extra_assets: t.Sequence[model.Asset] = ()) -> model.Portfolio:
+    withdrawal_year = datetime.datetime.now().year + 10
+    return model.Portfolio(
+        allocations=[
+            model.Allocation(
+                name="Stocks", proportion=0.6, asset_class=model.AssetClass.EQUITY_US
+            ),
+            model.Allocation(
+                name="Bonds", proportion=0.4, asset_class=model.AssetClass.FIXED_INCOME
+            ),
+        ],
+        accounts=[
+            model.Account(
+                name="Brokerage",
+                taxation_class=model.TaxationClass.TAX_EXEMPT,
+                withdrawal_year=withdrawal_year,
+                cash_balance=10000.0,
+                asset_lots=[model.AssetLot(ticker="VTI", shares=3000.0)],
+            ),
+            model.Account(
+                name="IRA",
+                taxation_class=model.TaxationClass.TAX_EXEMPT,
+                withdrawal_year=withdrawal_year,
+                cash_balance=5000.0,
+                asset_lots=[model.AssetLot(ticker="BND", shares=4000.0)],
+            ),
+        ],
+        assets=[
+            model.Asset(
+                ticker="VTI",
+                class_=model.AssetClass.EQUITY_US,
+                share_price=201.37,
+                shares_outstanding=1000000,
+            ),
+            model.Asset(
+                ticker="BND",
+                class_=model.AssetClass.FIXED_INCOME,
+                share_price=73.19,
+                shares_outstanding=1000000,
+            ),
+            *extra_assets,
+        ],
+        config=model.Config(drift_limit=0.01, same_tax_class_drift_limit=0),
+    )
+
+
+def _get_return_rates(
+    portfolio: model.Portfolio,
+) -> dict[tuple[str, str], float]:
+    return_rates_by_ticker = {"VTI": 0.07, "BND": 0.03, "SPAXX": 0.01}
+    return {
+        (account.id, asset.ticker): return_rates_by_ticker[asset.ticker]
+        for account in portfolio.accounts
+        for asset in portfolio.assets
+    }
+
+
+class RebalanceTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.solution_path = pathlib.Path(temporary_directory.name) / "solution.json"
+
+        for patcher in (
+            mock.patch.object(
+                rebalancing, "_PREVIOUS_SOLUTION_PATH", self.solution_path
+            ),
+            mock.patch.object(
+                rebalancing, "_get_projected_return_rates", _get_return_rates
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _rebalance(self, portfolio: model.Portfolio, fast: bool) -> dict[str, int]:
+        positions = rebalancing.rebalance(
+            portfolio,
+            rebalancing.AllowedSales.ALL,
+            max_time=60,
+            fast=fast,
+            solver=rebalancing.Solver.CBC,
+        )
+        return {
+            position.target_shares_variable.name: position.get_target_shares()
+            for position in positions
+        }
+
+    def _assert_valid(
+        self, portfolio: model.Portfolio, target_shares: dict[str, int]
+    ) -> None:
+        prices = {asset.ticker: asset.share_price for asset in portfolio.assets}
+        total_value = portfolio.get_total_value()
+        investments = {ticker: 0.0 for ticker in prices}
+        for account in portfolio.accounts:
+            account_investment = 0.0
+            for ticker, price in prices.items():
+                shares = target_shares[
+                    f"target_shares_account_{account.id}_asset_{ticker}"
+                ]
+                self.assertIsInstance(shares, float)
+                self.assertEqual(shares, int(shares))
+                account_investment += shares * price
+                investments[ticker] += shares * price
+            self.assertLessEqual(
+                account_investment, account.get_total_value(portfolio.assets)
+            )
+
+        stocks, bonds = portfolio.allocations
+        for allocation, ticker in ((stocks, "VTI"), (bonds, "BND")):
+            drift = allocation.proportion - investments[ticker] / total_value
+            self.assertLessEqual(abs(drift), portfolio.config.drift_limit + 1e-6)
+
+    def test_fast_accepts_rounded_solution(self) -> None:
+        portfolio = _make_portfolio()
+        solved_for_whole_shares = []
+        solve = pulp.LpProblem.solve
+
+        def record_solve(problem: pulp.LpProblem, *args: t.Any, **kwargs: t.Any) -> int:
+            solved_for_whole_shares.append(bool(problem.isMIP()))
+            return solve(problem, *args, **kwargs)
+
+        with mock.patch.object(pulp.LpProblem, "solve", record_solve):
+            target_shares = self._rebalance(portfolio, fast=True)
+
+        # Only the fractional relaxation should have needed solving
+        self.assertTrue(solved_for_whole_shares)
+        self.assertFalse(any(solved_for_whole_shares))
+        self._assert_valid(portfolio, target_shares)
+
+    def test_fast_ignores_free_asset(self) -> None:
+        portfolio = _make_portfolio(
+            [
+                model.Asset(
+                    ticker="SPAXX",
+                    class_=model.AssetClass.CASH,
+                    share_price=0.0,
+                    shares_outstanding=1000000,
+                )
+            ]
+        )
+
+        target_shares = self._rebalance(portfolio, fast=True)
+
+        self._assert_valid(portfolio, target_shares)
+
+    def test_ignores_invalid_previous_solution(self) -> None:
+        portfolio = _make_portfolio()
+        variable_names = [
+            f"target_shares_account_{account.id}_asset_{asset.ticker}"
+            for account in portfolio.accounts
+            for asset in portfolio.assets
+        ]
+        # JSON has no literals for NaN or infinity, but Python reads and writes them
+        self.solution_path.write_text(
+            json.dumps(dict(zip(variable_names, [-5, float("nan"), float("inf"), 10])))
+        )
+
+        self.assertEqual(
+            rebalancing._load_previous_target_shares(), {variable_names[3]: 10}
+        )
+
+        target_shares = self._rebalance(portfolio, fast=False)
+
+        self._assert_valid(portfolio, target_shares)
+
+    def test_skips_saving_solution_when_not_writable(self) -> None:
+        portfolio = _make_portfolio()
+        unwritable_path = self.solution_path / "missing" / "solution.json"
+
+        with mock.patch.object(rebalancing, "_PREVIOUS_SOLUTION_PATH", unwritable_path):
+            target_shares = self._rebalance(portfolio, fast=False)
+
+        self.assertFalse(unwritable_path.exists())
+        self._assert_valid(portfolio, target_shares)
+
+
+if __name__ == "__main__":
+    unittest.main()